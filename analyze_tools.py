@@ -6,7 +6,21 @@ May 7, 2019
 """
 
 import os
-from format_tools import load_object
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+from time import time as measure_time
+from matplotlib import pyplot as plt
+from matplotlib.patches import Patch
+from format_tools import load_object, save_object
+
+# Optional: only needed for run_tsne
+try:
+    import openTSNE
+except ImportError:
+    openTSNE = None
 
 def list_available(folder, condition=None):
     """ A function to list the available files in a folder that return True
@@ -79,3 +93,709 @@ def load_chosen(chosen_idx, folder, availables):
         print("\nSuccesfully loaded the following object: \n")
         print(df)
         return df
+
+###
+# Functions to select informative features before the dimensional reduction
+###
+def iter_chunks(source, chunksize=1000):
+    """ Yield the rows of a dataset chunk by chunk, so a large dataset
+    never has to be entirely converted to a dense array.
+
+    Args:
+        source (pd.DataFrame, np.ndarray, sparse matrix, str or list):
+            the data to iterate over. A frame or an array is split in
+            chunks of chunksize rows. A str is treated as the path to a
+            pickled object, and a list is iterated over element by
+            element, each being either an object or a file path
+            (e.g. the blocks saved in data/blocks/).
+        chunksize (int): number of rows per chunk when splitting a single
+            frame or array. Default 1000.
+
+    Yields:
+        (pd.DataFrame, np.ndarray or sparse matrix): consecutive chunks.
+    """
+    if isinstance(source, str):
+        source = load_object(source)
+    if isinstance(source, (list, tuple)):
+        for item in source:
+            yield load_object(item) if isinstance(item, str) else item
+    elif isinstance(source, pd.DataFrame):
+        for start in range(0, source.shape[0], chunksize):
+            yield source.iloc[start:start + chunksize]
+    else:
+        if sparse.issparse(source):
+            source = source.tocsr()  # efficient row slicing
+        for start in range(0, source.shape[0], chunksize):
+            yield source[start:start + chunksize]
+
+def _as_matrix(chunk):
+    """ Convert a chunk to a float ndarray or a CSC sparse matrix,
+    keeping sparse data sparse. """
+    if sparse.issparse(chunk):
+        return sparse.csc_matrix(chunk, dtype=float)
+    if isinstance(chunk, pd.DataFrame):
+        try:  # Only works if all columns are sparse
+            return sparse.csc_matrix(chunk.sparse.to_coo(), dtype=float)
+        except (AttributeError, TypeError, ValueError):
+            return np.asarray(chunk.values, dtype=float)
+    return np.asarray(chunk, dtype=float)
+
+def _chunk_moments(mat):
+    """ Number of rows, column means and column sums of squared deviations
+    from the mean (M2) for one chunk, dense or sparse. """
+    n = mat.shape[0]
+    if not sparse.issparse(mat):
+        mean = mat.mean(axis=0)
+        m2 = ((mat - mean)**2).sum(axis=0)
+        return n, mean, m2
+
+    # Sparse: implicit zeros each contribute mean**2 to M2, so only
+    # the stored values need to be visited.
+    mat.sum_duplicates()
+    nnz_per_col = np.diff(mat.indptr)
+    mean = np.asarray(mat.sum(axis=0)).ravel() / n
+    cols = np.repeat(np.arange(mat.shape[1]), nnz_per_col)
+    m2 = np.bincount(cols, weights=(mat.data - mean[cols])**2,
+                    minlength=mat.shape[1])
+    m2 += (n - nnz_per_col) * mean**2
+    return n, mean, m2
+
+def feature_statistics(source, chunksize=1000, ddof=1):
+    """ Compute the mean, variance and dispersion (variance/mean) of each
+    column in a single pass over the chunks of source. Moments of the chunks
+    are merged with the parallel version of Welford's algorithm (Chan et al.),
+    which is numerically stable and never needs more than one chunk
+    in memory. Sparse chunks are kept sparse.
+
+    Args:
+        source: any input accepted by iter_chunks (frame, array,
+            sparse matrix, file path, or list of chunks/file paths).
+        chunksize (int): number of rows per chunk, when source is split.
+        ddof (int): delta degrees of freedom for the variance.
+            Default 1, as for pd.DataFrame.var.
+
+    Returns:
+        (pd.DataFrame): one row per column of the data, with columns
+            "mean", "variance" and "dispersion". The index is the columns
+            of the first DataFrame chunk, or integer positions otherwise.
+    """
+    count, mean, m2 = 0, None, None
+    columns = None
+    for chunk in iter_chunks(source, chunksize=chunksize):
+        if columns is None and isinstance(chunk, pd.DataFrame):
+            columns = chunk.columns
+        n_b, mean_b, m2_b = _chunk_moments(_as_matrix(chunk))
+        if n_b == 0:
+            continue
+        if mean is None:
+            count, mean, m2 = n_b, mean_b, m2_b
+            continue
+        if mean_b.shape != mean.shape:
+            raise ValueError("All chunks must have the same number of columns")
+        # Merge the moments of the new chunk with the running ones
+        delta = mean_b - mean
+        new_count = count + n_b
+        mean = mean + delta * n_b / new_count
+        m2 = m2 + m2_b + delta**2 * count * n_b / new_count
+        count = new_count
+
+    if mean is None:
+        raise ValueError("There is no data in source")
+    if count <= ddof:
+        raise ValueError("Not enough rows to compute the variance")
+    variance = m2 / (count - ddof)
+    dispersion = np.divide(variance, mean, out=np.zeros_like(variance),
+                        where=(mean != 0))
+    if columns is None:
+        columns = pd.RangeIndex(mean.size)
+
+    return pd.DataFrame({"mean":mean, "variance":variance,
+                        "dispersion":dispersion}, index=columns)
+
+def select_variable_features(source, n_top=2000, criterion="dispersion",
+                            min_mean=None, chunksize=1000):
+    """ Find the n_top most variable columns of a dataset, streaming over
+    its chunks (see feature_statistics), so that only those columns need
+    to be given to t-SNE or UMAP.
+
+    Args:
+        source: any input accepted by iter_chunks.
+        n_top (int): the number of columns to keep. Default 2000.
+        criterion (str): "dispersion" (variance/mean, the usual choice
+            for count data) or "variance".
+        min_mean (float): optional. If given, columns with a mean lower
+            than or equal to this are never kept (e.g. genes that are
+            rarely expressed). Constant columns are never kept.
+        chunksize (int): number of rows per chunk, when source is split.
+
+    Returns:
+        (pd.Index): the labels (or positions, if source has no column labels)
+            of the columns to keep, in their original order.
+    """
+    if criterion not in ("dispersion", "variance"):
+        raise ValueError("criterion should be 'dispersion' or 'variance'")
+    stats = feature_statistics(source, chunksize=chunksize)
+    score = stats[criterion].values.copy()
+    score[~(stats["variance"].values > 0.)] = -np.inf
+    if min_mean is not None:
+        score[~(stats["mean"].values > min_mean)] = -np.inf
+    score[np.isnan(score)] = -np.inf
+
+    # Rank columns, then restore the original column order
+    kept = np.argsort(-score, kind="stable")[:n_top]
+    kept = np.sort(kept[np.isfinite(score[kept])])
+    return stats.index[kept]
+
+def stack_selected(source, columns, chunksize=1000, keys=None, names=None):
+    """ Build a dense DataFrame containing only some columns of a dataset,
+    converting it chunk by chunk so the full dense matrix never exists.
+
+    Args:
+        source: any input accepted by iter_chunks.
+        columns (pd.Index or list): the columns to keep, for instance
+            returned by select_variable_features. Labels for DataFrame chunks,
+            integer positions for arrays.
+        chunksize (int): number of rows per chunk, when source is split.
+        keys (list): optional. One label per chunk, added as an outer level
+            of the rows' index; e.g. the stimulation time of each block file
+            in data/blocks/, since that level was removed from the blocks.
+        names (list of str): optional. The name(s) of the levels made by keys.
+
+    Returns:
+        (pd.DataFrame): the narrow, dense DataFrame.
+    """
+    frames = []
+    labelled = True  # False if some chunks have no row labels
+    for chunk in iter_chunks(source, chunksize=chunksize):
+        if isinstance(chunk, pd.DataFrame):
+            chunk = chunk.loc[:, columns]
+            try:
+                chunk = chunk.sparse.to_dense()
+            except AttributeError:  # Already dense
+                pass
+        else:
+            chunk = chunk[:, np.asarray(columns)]
+            if sparse.issparse(chunk):
+                chunk = chunk.toarray()
+            chunk = pd.DataFrame(chunk, columns=columns)
+            labelled = False
+        frames.append(chunk)
+    if keys is not None:
+        if len(keys) != len(frames):
+            raise ValueError("There must be one key per chunk")
+        return pd.concat(frames, keys=keys, names=names)
+    return pd.concat(frames, ignore_index=not labelled)
+
+###
+# Plotting large embeddings
+###
+def density_image(y, bins=512, extent=None, categories=None):
+    """ Count the embedded points falling in each pixel of a regular grid,
+    separately for each category, with vectorized binning (no loop over
+    points or categories).
+
+    Args:
+        y (np.ndarray): the (n_points, 2) coordinates, e.g. returned
+            by fit_transform.
+        bins (int or tuple of 2 ints): number of pixels along y_1 and y_2.
+        extent (tuple): optional. (y1_min, y1_max, y2_min, y2_max); points
+            outside are dropped. Default: the range of y. Points with
+            non-finite coordinates are always dropped.
+        categories (array-like): optional. The category of each point.
+
+    Returns:
+        counts (np.ndarray): shape (n_categories, bins_y2, bins_y1), ready
+            for imshow with origin="lower".
+        extent (tuple): the extent of the grid.
+        labels (pd.Index): the category of each layer of counts
+            (a single None if categories is None).
+    """
+    y = np.asarray(y, dtype=float)
+    nx, ny = (bins, bins) if np.isscalar(bins) else bins
+    finite = np.all(np.isfinite(y), axis=1)
+    if not np.any(finite):
+        raise ValueError("There are no points with finite coordinates in y")
+    if extent is None:
+        extent = (np.nanmin(y[finite, 0]), np.nanmax(y[finite, 0]),
+                np.nanmin(y[finite, 1]), np.nanmax(y[finite, 1]))
+    x0, x1, y0, y1 = extent
+    # Non-finite points are never inside
+    inside = finite & (y[:, 0] >= x0) & (y[:, 0] <= x1) \
+        & (y[:, 1] >= y0) & (y[:, 1] <= y1)
+
+    if categories is None:
+        codes, labels = np.zeros(y.shape[0], dtype=np.intp), pd.Index([None])
+    else:
+        codes, labels = pd.factorize(np.asarray(categories), sort=True)
+        inside &= (codes >= 0)  # NaN categories are dropped
+
+    # Pixel coordinates; the upper edge (and points rounded up to it)
+    # belong to the last pixel
+    ix = np.floor((y[inside, 0] - x0) / (x1 - x0 or 1.) * nx).astype(np.intp)
+    iy = np.floor((y[inside, 1] - y0) / (y1 - y0 or 1.) * ny).astype(np.intp)
+    np.clip(ix, 0, nx - 1, out=ix)
+    np.clip(iy, 0, ny - 1, out=iy)
+
+    flat = (codes[inside] * ny + iy) * nx + ix
+    counts = np.bincount(flat, minlength=len(labels)*ny*nx)
+    return counts.reshape(len(labels), ny, nx), extent, labels
+
+def _category_colors(n, cmap=None):
+    """ n distinct RGB colors, one per category. Qualitative colormaps are
+    used color by color; if they have fewer than n colors, or for
+    continuous colormaps, n colors are sampled evenly instead. """
+    if cmap is None:
+        cmap = "tab10" if n <= 10 else ("tab20" if n <= 20 else "turbo")
+    colormap = plt.get_cmap(cmap)
+    if colormap.N < 256 and n > colormap.N:
+        warnings.warn("The colormap {0} has only {1} colors for {2} "
+            "categories; using turbo instead".format(cmap, colormap.N, n))
+        colormap = plt.get_cmap("turbo")
+    if colormap.N < 256:
+        return colormap(np.arange(n))[:, :3]
+    return colormap(np.linspace(0., 1., n))[:, :3]
+
+def plot_density(y, index=None, level=None, ax=None, bins=512, extent=None,
+                cmap=None, log=True):
+    """ Plot an embedding as a single image of the density of points,
+    instead of one marker per point with ax.scatter. Rendering time barely
+    depends on the number of points, so it is suited to millions of points.
+
+    If level is given, each pixel is colored by the mean color of the
+    categories of its points (in that level of index), and its brightness
+    is given by the number of points.
+
+    Args:
+        y (np.ndarray): the (n_points, 2) coordinates.
+        index (pd.Index or pd.MultiIndex): optional. The labels of the
+            rows of y, e.g. df.index.
+        level (str or int): optional. The level of index used to color
+            the points, e.g. "stim".
+        ax (matplotlib.axes.Axes): optional. Where to plot; default:
+            the current axes.
+        bins (int or tuple of 2 ints): number of pixels along y_1 and y_2.
+        extent (tuple): optional. (y1_min, y1_max, y2_min, y2_max).
+        cmap (str): optional. matplotlib colormap for the categories
+            (default "tab10", "tab20" or "turbo" depending on the number
+            of categories), or for the density if level is None
+            (default "viridis").
+        log (bool): if True, brightness scales with log(1 + counts).
+
+    Returns:
+        ax (matplotlib.axes.Axes): the axes where the image was drawn.
+    """
+    if ax is None:
+        ax = plt.gca()
+    categories = None
+    if level is not None:
+        if index is None:
+            raise ValueError("An index must be given to color by level")
+        categories = index.get_level_values(level)
+    counts, extent, labels = density_image(y, bins=bins, extent=extent,
+                                            categories=categories)
+    total = counts.sum(axis=0)
+    density = np.log1p(total) if log else total.astype(float)
+    density = density / (density.max() or 1.)
+
+    if categories is None:
+        ax.imshow(np.ma.masked_equal(density, 0), origin="lower",
+                extent=extent, cmap=cmap or "viridis",
+                aspect="auto", interpolation="nearest")
+    else:
+        # Mean color of the points in each pixel, then opacity from density
+        colors = _category_colors(len(labels), cmap)
+        rgb = np.tensordot(counts, colors, axes=([0], [0]))
+        rgb /= np.maximum(total, 1)[:, :, None]
+        image = np.concatenate([rgb, density[:, :, None]], axis=2)
+        ax.imshow(image, origin="lower", extent=extent, aspect="auto",
+                interpolation="nearest")
+        handles = [Patch(color=colors[i], label=str(labels[i]))
+                    for i in range(len(labels))]
+        ax.legend(handles=handles, title=categories.name)
+    ax.set_xlabel(r"$y_1$")
+    ax.set_ylabel(r"$y_2$")
+    return ax
+
+###
+# Nearest-neighbor queries in the ambient and embedded spaces
+###
+def _principal_axes(x, n_components):
+    """ Mean and first n_components principal axes (as columns) of the
+    rows of x. With few columns, from the covariance matrix of the columns;
+    otherwise from an SVD (randomized and truncated, unless there are few
+    rows) of the centered data. """
+    center = x.mean(axis=0)
+    n_components = min(n_components, *x.shape)
+    if x.shape[1] <= 1000:
+        xc = x - center
+        eigvals, eigvecs = np.linalg.eigh(xc.T.dot(xc))
+        order = np.argsort(eigvals)[::-1][:n_components]
+        return center, np.ascontiguousarray(eigvecs[:, order])
+    if x.shape[0] <= 1000:  # few rows: the thin SVD is cheap
+        _, _, vt = np.linalg.svd(x - center, full_matrices=False)
+        return center, np.ascontiguousarray(vt[:n_components].T)
+
+    # Randomized SVD (Halko et al., 2011) of x - center, which is never
+    # formed: only products with a few vectors are needed
+    def dot(v):
+        return x.dot(v) - np.outer(np.ones(x.shape[0]), center.dot(v))
+    def rdot(v):
+        return x.T.dot(v) - np.outer(center, v.sum(axis=0))
+    rng = np.random.RandomState(0)
+    q = dot(rng.normal(size=(x.shape[1], n_components + 10)))
+    for i in range(4):  # power iterations, for a slowly decaying spectrum
+        q, _ = np.linalg.qr(q)
+        q, _ = np.linalg.qr(rdot(q))
+        q = dot(q)
+    q, _ = np.linalg.qr(q)
+    _, _, vt = np.linalg.svd(rdot(q).T, full_matrices=False)
+    return center, np.ascontiguousarray(vt[:n_components].T)
+
+class NeighborIndex(object):
+    """ k-d trees over the observables (ambient space) and the coordinates
+    of an embedding (embedded space) of the same rows, to find the cells
+    nearest to given points without brute-force distance computations.
+    Results are labelled with the rows' (Multi)Index.
+
+    Args:
+        frame (pd.DataFrame): the formatted data, one row per sample point.
+            Use the reduced frame (e.g. from stack_selected): k-d trees
+            are only efficient in a moderate number of dimensions.
+        embedding (np.ndarray or pd.DataFrame): optional. The coordinates
+            of the rows of frame in the embedded space, e.g. returned by
+            fit_transform, in the same order as frame. A DataFrame is
+            aligned on frame.index first.
+        n_components (int): optional. If given, the ambient space is first
+            projected on its n_components principal axes, and queries are
+            projected the same way.
+        leafsize (int): leaf size of the k-d trees, see cKDTree.
+    """
+    def __init__(self, frame, embedding=None, n_components=None, leafsize=16):
+        self.labels = frame.index
+        self.columns = frame.columns
+        self.leafsize = leafsize
+        ambient = _as_matrix(frame)
+        if sparse.issparse(ambient):
+            ambient = ambient.toarray()
+
+        self.center, self.components = None, None
+        if n_components is not None:
+            self.center, self.components = _principal_axes(ambient,
+                                                            n_components)
+            ambient = (ambient - self.center).dot(self.components)
+        self.data = {"ambient":np.ascontiguousarray(ambient, dtype=float)}
+
+        if embedding is not None:
+            if isinstance(embedding, pd.DataFrame):
+                embedding = embedding.reindex(self.labels).values
+            if embedding.shape[0] != len(self.labels):
+                raise ValueError("There must be one embedded point per row of frame")
+            self.data["embedded"] = np.ascontiguousarray(embedding, dtype=float)
+        self._build_trees()
+
+    def _build_trees(self):
+        # copy_data=False: memory-mapped data stays on disk
+        self.trees = {sp:cKDTree(self.data[sp], leafsize=self.leafsize,
+                                copy_data=False) for sp in self.data}
+
+    def _check_query(self, k, space, k_max=None):
+        """ Raise a ValueError if the space is not indexed or if k is not
+        between 1 and k_max (default: the number of rows in the index) """
+        if space not in self.trees:
+            raise ValueError("No index for the {} space; ".format(space)
+                + "available: {}".format(list(self.trees.keys())))
+        if k_max is None:
+            k_max = len(self.labels)
+        if not 1 <= k <= k_max:
+            raise ValueError("k must be between 1 and {}".format(k_max))
+
+    def _transform(self, points, space):
+        """ Bring query points to the coordinates used by the tree """
+        if isinstance(points, pd.DataFrame) and space == "ambient":
+            points = points.reindex(columns=self.columns, fill_value=0)
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        if space == "ambient" and self.components is not None:
+            points = (points - self.center).dot(self.components)
+        return points
+
+    def query(self, points, k=5, space="ambient", n_jobs=1):
+        """ Find the k nearest rows of each query point.
+
+        Args:
+            points (np.ndarray or pd.DataFrame): one query point per row.
+                In the ambient space, a DataFrame is aligned on the columns
+                of the indexed frame (missing observables are set to 0).
+            k (int): the number of neighbors per query point.
+            space (str): "ambient" or "embedded".
+            n_jobs (int): number of workers for the queries (-1: all CPUs).
+
+        Returns:
+            (pd.DataFrame): one row per (query, rank) pair, with the labels
+                of the neighbor (one column per level of the index) and
+                its distance to the query point.
+        """
+        dist, pos = self._query_positions(points, k, space, n_jobs)
+        return self._label_results(dist, pos)
+
+    def _query_positions(self, points, k, space, n_jobs):
+        """ Distances and row positions of the k nearest neighbors,
+        as (n_points, k) arrays """
+        self._check_query(k, space)
+        points = self._transform(points, space)
+        dist, pos = self.trees[space].query(points, k=k, workers=n_jobs)
+        return dist.reshape(len(points), k), pos.reshape(len(points), k)
+
+    def neighbors_of(self, keys, k=5, space="embedded", n_jobs=1):
+        """ Find the k nearest rows of rows already in the index, excluding
+        each row itself.
+
+        Args:
+            keys (list): labels of the rows (tuples for a MultiIndex).
+            k, space, n_jobs: see query.
+
+        Returns:
+            (pd.DataFrame): see query.
+        """
+        # Each row is its own neighbor, so one less row is available
+        self._check_query(k, space, k_max=len(self.labels) - 1)
+        positions = self.labels.get_indexer(keys)
+        if np.any(positions < 0):
+            raise KeyError("Some keys are not in the index")
+        dist, pos = self.trees[space].query(self.data[space][positions],
+                                            k=k + 1, workers=n_jobs)
+        # Drop each row itself, which is not necessarily first if duplicated
+        not_self = pos != positions[:, None]
+        keep = np.cumsum(not_self, axis=1) <= k
+        mask = not_self & keep
+        dist = dist[mask].reshape(len(positions), k)
+        pos = pos[mask].reshape(len(positions), k)
+        return self._label_results(dist, pos)
+
+    def predict_level(self, points, level, k=15, space="ambient", n_jobs=1):
+        """ Assign to each query point the most frequent label of some index
+        level among its k nearest rows (e.g. which cluster or cell type
+        is a new cell closest to).
+
+        Args:
+            points: see query.
+            level (str or int): the index level to vote on.
+            k, space, n_jobs: see query.
+
+        Returns:
+            (pd.Series): the predicted label of each query point, indexed
+                like points if it is a DataFrame.
+        """
+        dist, pos = self._query_positions(points, k, space, n_jobs)
+        values = self.labels.get_level_values(level)
+        votes = pd.DataFrame({"query":np.repeat(np.arange(pos.shape[0]), k),
+                            "label":values[pos.ravel()]})
+        counts = votes.groupby(["query", "label"], sort=False,
+                                observed=True).size()
+        # Most votes first; ties are broken by the closest neighbor
+        pred = counts.groupby(level=0, sort=True).idxmax().map(
+            lambda x: x[1]).rename(values.name)
+        if isinstance(points, pd.DataFrame):
+            pred.index = points.index
+        return pred
+
+    def _label_results(self, dist, pos):
+        n_q, k = pos.shape
+        idx = pd.MultiIndex.from_product([range(n_q), range(k)],
+                                        names=["Query", "Rank"])
+        res = self.labels[pos.ravel()].to_frame(index=False)
+        res.index = idx
+        res["distance"] = dist.ravel()
+        return res
+
+    def save(self, folder):
+        """ Save the index in folder (created if needed): one .npy file per
+        space, so they can be memory-mapped by load_neighbor_index, and a
+        pickle file for the labels and the projection.
+        """
+        os.makedirs(folder, exist_ok=True)
+        for sp in self.data:
+            np.save(os.path.join(folder, sp + ".npy"), self.data[sp])
+        info = {"labels":self.labels, "columns":self.columns,
+                "leafsize":self.leafsize, "center":self.center,
+                "components":self.components, "spaces":list(self.data)}
+        save_object(info, os.path.join(folder, "index_info.pkl"))
+
+def load_neighbor_index(folder, mmap_mode="r"):
+    """ Load a NeighborIndex saved with NeighborIndex.save. The points are
+    memory-mapped rather than read in RAM; only the trees are rebuilt.
+
+    Args:
+        folder (str): the folder given to NeighborIndex.save.
+        mmap_mode (str): see np.load. Use None to read the points in RAM.
+
+    Returns:
+        (NeighborIndex): the loaded index.
+    """
+    info = load_object(os.path.join(folder, "index_info.pkl"))
+    index = NeighborIndex.__new__(NeighborIndex)
+    for attr in ("labels", "columns", "leafsize", "center", "components"):
+        setattr(index, attr, info[attr])
+    index.data = {sp:np.load(os.path.join(folder, sp + ".npy"),
+                            mmap_mode=mmap_mode) for sp in info["spaces"]}
+    index._build_trees()
+    return index
+
+###
+# t-SNE with convergence monitoring, early stopping and warm start
+###
+def _tsne_init(x, init, labels, random_state):
+    """ Initial embedding: "pca", "random", an array, or a DataFrame of a
+    previous embedding, whose rows are aligned on labels. Rows missing from
+    the previous embedding start at the position of their nearest
+    neighbor (in x) among the rows that are present. """
+    n = x.shape[0]
+    rng = np.random.RandomState(random_state)
+    if isinstance(init, str):
+        if init == "pca":
+            center, components = _principal_axes(x, 2)
+            y = (x - center).dot(components)
+        elif init == "random":
+            y = rng.normal(size=(n, 2))
+        else:
+            raise ValueError("init should be 'pca', 'random' or an embedding")
+        # Small initial scale, as usual for t-SNE
+        return 1e-4 * y / (np.std(y[:, 0]) or 1.)
+
+    if isinstance(init, pd.DataFrame):
+        if labels is None:
+            raise ValueError("Give x as a DataFrame to align a previous "
+                            + "embedding on its rows")
+        y = init.reindex(labels).values.astype(float)
+        missing = np.isnan(y).any(axis=1)
+        if np.all(missing):
+            raise ValueError("No row of x is in the previous embedding")
+        if np.any(missing):
+            _, nearest = cKDTree(x[~missing]).query(x[missing])
+            y[missing] = y[~missing][nearest] \
+                + 1e-4 * rng.normal(size=(missing.sum(), 2))
+        return y
+    y = np.array(init, dtype=float)
+    if y.shape != (n, 2):
+        raise ValueError("The initial embedding should have shape (n, 2)")
+    return y
+
+class _ConvergenceMonitor(object):
+    """ openTSNE callback recording the KL divergence and elapsed time,
+    and stopping the optimization when the KL divergence flattens. """
+    def __init__(self, tol, start_time, verbose):
+        self.tol = tol
+        self.start_time = start_time
+        self.verbose = verbose
+        self.history = []
+        self.offset = 0  # iterations done in previous phases
+        self.check = False  # no early stopping during exaggeration
+        self.converged = False
+
+    def __call__(self, iteration, kl, embedding):
+        it = self.offset + iteration
+        elapsed = measure_time() - self.start_time
+        if self.verbose:
+            print("Iteration {0}: KL divergence = {1:.4f}, {2:.2f} s".format(
+                it, kl, elapsed))
+        previous = self.history[-1][1] if self.history else np.inf
+        self.history.append((it, kl, elapsed))
+        if not self.check:
+            return False
+        if (previous - kl) < self.tol * abs(previous):
+            self.converged = True
+            if self.verbose:
+                print("Converged after {} iterations".format(it))
+        return self.converged
+
+def run_tsne(x, init="pca", perplexity=30., learning_rate="auto",
+            early_exaggeration=12., n_iter_early=None, n_iter=1000,
+            tol=1e-3, check_every=25, n_jobs=1, random_state=None,
+            verbose=True):
+    """ Run t-SNE while monitoring the KL divergence, stopping as soon as it
+    does not improve anymore, and possibly starting from a previous
+    embedding of (mostly) the same rows.
+
+    The optimization is done by openTSNE (pip install openTSNE), which
+    approximates the gradient with Barnes-Hut below 10,000 points and with
+    FFT-accelerated interpolation above, so it scales to millions of points.
+    openTSNE calls back every check_every iterations to record the
+    KL divergence and stop the optimization.
+
+    Args:
+        x (pd.DataFrame or np.ndarray): the data, one point per row.
+        init (str, np.ndarray or pd.DataFrame): "pca" (default), "random",
+            an (n, 2) array, or a previously saved embedding as a DataFrame
+            indexed like x (see embedding_frame), for a warm start. New rows
+            are placed next to their nearest neighbor.
+        perplexity (float): the effective number of neighbors, 5 to 50.
+        learning_rate (float or str): the step size of the gradient descent.
+            "auto" uses n / exaggeration in each phase (Belkina et al., 2019).
+        early_exaggeration (float): factor multiplying P at first, so that
+            natural clusters form and separate.
+        n_iter_early (int): number of iterations with early exaggeration.
+            Default: 250 for the "pca" and "random" initializations, 0 for
+            an array or DataFrame init, to keep its layout.
+        n_iter (int): maximum total number of iterations.
+        tol (float): stop when the relative decrease of the KL divergence
+            over check_every iterations (after exaggeration) is below tol.
+        check_every (int): number of iterations between convergence checks
+            and progress reports.
+        n_jobs (int): number of threads (-1: all CPUs).
+        random_state (int): seed for the random initialization and the
+            nearest neighbor search.
+        verbose (bool): if True, print the KL divergence and elapsed time
+            at each check.
+
+    Returns:
+        y (np.ndarray): the (n, 2) embedding.
+        history (pd.DataFrame): the KL divergence and elapsed time (s)
+            at each check.
+    """
+    if openTSNE is None:
+        raise ImportError("run_tsne needs openTSNE: pip install openTSNE")
+    labels = x.index if isinstance(x, pd.DataFrame) else None
+    x = _as_matrix(x)
+    x = np.ascontiguousarray(x.toarray() if sparse.issparse(x) else x)
+    start_time = measure_time()
+
+    y = _tsne_init(x, init, labels, random_state)
+    if n_iter_early is None:
+        n_iter_early = 250 if isinstance(init, str) else 0
+    n_iter_early = min(n_iter_early, n_iter)
+    affinities = openTSNE.affinity.PerplexityBasedNN(x, perplexity=perplexity,
+                        n_jobs=n_jobs, random_state=random_state)
+    if verbose:
+        print("Affinities computed in {:.2f} s".format(
+                                            measure_time() - start_time))
+
+    monitor = _ConvergenceMonitor(tol, start_time, verbose)
+    embedding = openTSNE.TSNEEmbedding(y, affinities, n_jobs=n_jobs,
+                        random_state=random_state, callbacks=monitor,
+                        callbacks_every_iters=check_every)
+    if n_iter_early > 0:
+        embedding = embedding.optimize(n_iter=n_iter_early,
+            exaggeration=early_exaggeration, momentum=0.5,
+            learning_rate=learning_rate)
+    monitor.offset, monitor.check = n_iter_early, True
+    if n_iter > n_iter_early:
+        embedding = embedding.optimize(n_iter=n_iter - n_iter_early,
+            exaggeration=1., momentum=0.8, learning_rate=learning_rate)
+
+    history = pd.DataFrame(monitor.history, columns=["iteration",
+                        "kl_divergence", "time"]).set_index("iteration")
+    return np.asarray(embedding), history
+
+def embedding_frame(y, index):
+    """ Label the coordinates of an embedding with the rows of the data,
+    so it can be saved and reused to warm-start run_tsne after the data
+    changed a little.
+
+    Args:
+        y (np.ndarray): the (n, 2) embedding.
+        index (pd.Index or pd.MultiIndex): the rows of the embedded data.
+
+    Returns:
+        (pd.DataFrame): the embedding, with columns "y_1" and "y_2".
+    """
+    return pd.DataFrame(y, index=index,
+                        columns=["y_{}".format(i+1) for i in range(y.shape[1])])
@@ -6,8 +6,20 @@ May 3, 2019
 
 import numpy as np
 import pandas as pd
+import tempfile
+import warnings
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+
+from scipy import sparse
 
 from format_tools import df_from_blocks, df_from_ndarray, regroup_levels
+from analyze_tools import (feature_statistics, select_variable_features,
+                            stack_selected, NeighborIndex, load_neighbor_index,
+                            _principal_axes,
+                            density_image, plot_density, run_tsne,
+                            embedding_frame)
 
 def test_ndimarray():
     # Setup a simple example: conditions are T and p, obs are first axis
@@ -159,6 +171,255 @@ def test_regroup():
     ret = regroup_levels(df, groups, level_group="Pressure", axis=0, name="Effect")
     print(ret)
 
+def test_feature_selection():
+    # Sparse count data, with a few very variable columns
+    rng = np.random.RandomState(4)
+    arr = rng.poisson(0.3, size=(250, 40)).astype(float)
+    arr[:, [3, 17, 28]] *= rng.randint(5, 20, size=(250, 3))
+    arr[:, 10] = 0.  # never expressed
+    df = pd.DataFrame(arr, columns=["g{}".format(i) for i in range(40)])
+
+    # The streamed statistics should match those computed in one go,
+    # for dense frames, sparse matrices and lists of blocks
+    expected_var = df.var(axis=0).values
+    stats = feature_statistics(df, chunksize=37)
+    print(stats)
+    assert np.allclose(stats["mean"].values, arr.mean(axis=0))
+    assert np.allclose(stats["variance"].values, expected_var)
+    stats_sp = feature_statistics(sparse.csr_matrix(arr), chunksize=64)
+    assert np.allclose(stats_sp["variance"].values, expected_var)
+    blocks = [df.iloc[:100], df.iloc[100:101], df.iloc[101:]]
+    stats_bl = feature_statistics(blocks)
+    assert np.allclose(stats_bl["variance"].values, expected_var)
+    assert stats_bl["dispersion"]["g10"] == 0.
+
+    kept = select_variable_features(df, n_top=3, chunksize=50)
+    print(kept)
+    assert list(kept) == ["g3", "g17", "g28"], "wrong features selected"
+    kept_var = select_variable_features(arr, n_top=5, criterion="variance")
+    assert set([3, 17, 28]).issubset(kept_var)
+
+    # Asking for more columns than available never keeps empty columns
+    assert "g10" not in select_variable_features(df, n_top=40)
+
+    # With criterion="variance", columns with negative means are kept too
+    centered = pd.DataFrame(rng.normal(-3., 1., size=(500, 20)))
+    centered.iloc[:, :10] *= 5.
+    kept_var = select_variable_features(centered, n_top=10, criterion="variance")
+    assert list(kept_var) == list(range(10)), "negative-mean columns dropped"
+    assert len(select_variable_features(df, n_top=40, min_mean=0.5)) < 40
+
+    # Sparse pandas frames, as produced by csv_to_sparse
+    df_sp = df.astype(pd.SparseDtype(float, 0.))
+    stats_sp = feature_statistics(df_sp, chunksize=64)
+    assert np.allclose(stats_sp["variance"].values, expected_var)
+    assert list(select_variable_features(df_sp, n_top=3)) == list(kept)
+    narrow = stack_selected(df_sp, kept, chunksize=60)
+    assert not any(isinstance(d, pd.SparseDtype) for d in narrow.dtypes)
+    assert np.all(narrow.values == arr[:, [3, 17, 28]])
+
+    # Blocks lost their block label; it can be added back with keys
+    narrow = stack_selected(blocks, kept, keys=["0h", "1h", "4h"],
+                            names=["stim"])
+    assert narrow.index.names[0] == "stim"
+    assert len(narrow.xs("1h", level="stim")) == 1
+    try:
+        stack_selected(blocks, kept, keys=["0h", "1h"])
+    except ValueError as e: print(e)
+    else: raise AssertionError("Wrong number of keys was accepted")
+
+    narrow = stack_selected(df, kept, chunksize=60)
+    assert narrow.shape == (250, 3)
+    assert np.all(narrow.values == arr[:, [3, 17, 28]])
+    narrow = stack_selected(sparse.csr_matrix(arr), [3, 17], chunksize=60)
+    assert np.all(narrow.values == arr[:, [3, 17]])
+
+def test_neighbor_index():
+    # Two well-separated groups of cells, in 6 dimensions
+    rng = np.random.RandomState(12)
+    arr = np.vstack([rng.normal(0., 1., size=(60, 6)),
+                    rng.normal(10., 1., size=(40, 6))])
+    groups = ["a"]*60 + ["b"]*40
+    idx = pd.MultiIndex.from_arrays([groups, range(100)],
+                                    names=["Group", "Cell"])
+    df = pd.DataFrame(arr, index=idx, columns=list("uvwxyz"))
+    embedding = arr[:, :2] * 0.5
+
+    index = NeighborIndex(df, embedding)
+    queries = rng.normal(5., 5., size=(7, 6))
+    res = index.query(queries, k=4)
+    print(res)
+    assert list(res.columns) == ["Group", "Cell", "distance"]
+
+    # Compare with brute force
+    dists = np.sqrt(((queries[:, None, :] - arr[None, :, :])**2).sum(axis=2))
+    brute = np.argsort(dists, axis=1)[:, :4]
+    assert np.all(res["Cell"].values.reshape(7, 4) == brute)
+    assert np.allclose(res["distance"].values,
+                    np.sort(dists, axis=1)[:, :4].ravel())
+
+    # Neighbors of cells in the index exclude the cell itself
+    res = index.neighbors_of([("a", 3), ("b", 70)], k=3, space="embedded")
+    assert 3 not in res.loc[0, "Cell"].values
+    assert np.all(res.loc[1, "Group"] == "b")
+
+    # Predict the group of new cells
+    new = pd.DataFrame(rng.normal(10., 1., size=(3, 6)), columns=list("uvwxyz"))
+    assert np.all(index.predict_level(new, "Group", k=5) == "b")
+
+    # Too many neighbors, or a space that was not indexed
+    res = index.query(queries, k=100)
+    assert res.shape[0] == 7 * 100
+    assert np.all(res.groupby(level="Query").size() == 100)
+    try:
+        index.query(queries, k=101)
+    except ValueError as e: print(e)
+    else: raise AssertionError("k larger than the index was accepted")
+    try:
+        index.neighbors_of([("a", 3)], k=100)
+    except ValueError as e: print(e)
+    else: raise AssertionError("k + 1 larger than the index was accepted")
+    try:
+        NeighborIndex(df).neighbors_of([("a", 3)], k=3)
+    except ValueError as e: print(e)
+    else: raise AssertionError("Missing embedded space was not detected")
+
+    # Principal axes of wide data, from the randomized SVD (many rows) or
+    # thin SVD (few rows), capture as much variance as the exact ones
+    wide = rng.normal(size=(1200, 1100)) * np.linspace(5., 0.1, 1100)
+    wide[:, :4] *= 5.
+    for rows in (wide, wide[:30]):
+        center, axes = _principal_axes(rows, 3)
+        assert axes.shape == (1100, 3)
+        assert np.allclose(center, rows.mean(axis=0))
+        assert np.allclose(axes.T.dot(axes), np.eye(3))
+        sing_vals = np.linalg.svd(rows - center, compute_uv=False)
+        assert np.isclose(np.sum((rows - center).dot(axes)**2),
+                        np.sum(sing_vals[:3]**2), rtol=1e-6)
+
+    # A projected index should give the same group, and survive a round trip
+    index = NeighborIndex(df, embedding, n_components=3)
+    with tempfile.TemporaryDirectory() as folder:
+        index.save(folder)
+        loaded = load_neighbor_index(folder)
+        assert isinstance(loaded.data["ambient"], np.memmap)
+        res = loaded.query(queries, k=4)
+        assert res.equals(index.query(queries, k=4))
+        assert np.all(loaded.predict_level(new, "Group", k=5) == "b")
+        res = loaded.query(embedding[:2], k=1, space="embedded")
+        assert list(res["Cell"]) == [0, 1]
+        del loaded, res  # release the memory-mapped files
+
+def test_density():
+    # Embedding of points in three stimulation conditions
+    rng = np.random.RandomState(3)
+    y = rng.normal(size=(5000, 2))
+    stim = rng.choice(["0h", "1h", "4h"], size=5000)
+    idx = pd.MultiIndex.from_arrays([stim, range(5000)], names=["stim", "Cell"])
+
+    # Same counts as numpy's 2d histogram, for each category
+    counts, extent, labels = density_image(y, bins=(40, 30), categories=stim)
+    assert counts.shape == (3, 30, 40)
+    assert list(labels) == ["0h", "1h", "4h"]
+    assert counts.sum() == 5000, "Points on the edges were dropped"
+    hist, _, _ = np.histogram2d(y[stim == "1h", 0], y[stim == "1h", 1],
+        bins=(40, 30), range=[extent[:2], extent[2:]])
+    assert np.all(counts[1] == hist.T)
+
+    # Points outside of the extent are dropped
+    counts, _, _ = density_image(y, bins=10, extent=(0., 1., 0., 1.))
+    assert counts.shape == (1, 10, 10)
+    assert counts.sum() == np.sum(np.all((y >= 0.) & (y <= 1.), axis=1))
+
+    # Points just below the upper edge are not lost to rounding
+    y_edge = np.array([[-2., 0.], [np.nextafter(1.3, 0.), .5], [1.3, 1.]])
+    for b in (3, 5, 7, 11, 13, 100, 333):
+        assert density_image(y_edge, bins=b)[0].sum() == 3
+    for i in range(200):
+        lims = np.sort(rng.uniform(-50., 50., size=2))
+        y_edge = np.array([[lims[0], 0.], [np.nextafter(lims[1], lims[0]), 1.]])
+        assert density_image(y_edge, bins=rng.randint(2, 500))[0].sum() == 2
+
+    # Non-finite coordinates are dropped, the others are still counted
+    y_nan = y.copy()
+    y_nan[0, 0], y_nan[1, 1] = np.nan, np.inf
+    counts, extent, _ = density_image(y_nan, bins=20)
+    assert counts.sum() == 4998
+    assert np.all(np.isfinite(extent))
+
+    fig, axes = plt.subplots(1, 2)
+    plot_density(y, idx, level="stim", ax=axes[0], bins=64)
+    plot_density(y, ax=axes[1], bins=64)
+    assert len(axes[0].get_images()) == 1
+    plt.close(fig)
+
+    # Many categories should never share a color, in the legend or image
+    cell_types = np.array(list("abcdefghijkl"))[rng.randint(12, size=5000)]
+    idx = pd.MultiIndex.from_arrays([cell_types, range(5000)],
+                                    names=["type", "Cell"])
+    for cmap in (None, "viridis"):
+        ax = plot_density(y, idx, level="type", bins=64, cmap=cmap)
+        colors = [h.get_facecolor()[:3] for h in ax.get_legend().legend_handles]
+        assert len(set(colors)) == 12, "Categories share colors"
+        plt.close(ax.figure)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        ax = plot_density(y, idx, level="type", bins=64, cmap="tab10")
+        assert len(caught) == 1
+    colors = [h.get_facecolor()[:3] for h in ax.get_legend().legend_handles]
+    assert len(set(colors)) == 12, "Colormap with too few colors was reused"
+    plt.close(ax.figure)
+
+def test_tsne():
+    # Three well-separated clusters
+    rng = np.random.RandomState(7)
+    arr = np.vstack([rng.normal(c, 1., size=(50, 5)) for c in (0., 8., 16.)])
+    groups = np.repeat(["a", "b", "c"], 50)
+    idx = pd.MultiIndex.from_arrays([groups, range(150)], names=["Group", "Cell"])
+    df = pd.DataFrame(arr, index=idx)
+
+    # Should stop before n_iter once the KL divergence flattens
+    y, history = run_tsne(df, perplexity=10., n_iter=2000, check_every=25,
+                        random_state=1, verbose=False)
+    print(history)
+    assert y.shape == (150, 2)
+    assert history.index[-1] < 2000, "Early stopping did not happen"
+    assert np.all(np.diff(history.index) == 25)
+    assert history["kl_divergence"].iloc[-1] < history["kl_divergence"][250]
+    assert np.all(np.diff(history["time"].values) >= 0.)
+    _, nearest = NeighborIndex(pd.DataFrame(y, index=idx)).trees[
+        "ambient"].query(y, k=2)
+    assert np.all(groups[nearest[:, 1]] == groups), "Clusters are mixed"
+
+    # Warm start after a small change of the data: a few rows removed,
+    # one row added, which is absent from the previous embedding
+    previous = embedding_frame(y, idx)
+    df2 = pd.concat([df.iloc[5:], pd.DataFrame(arr[:1] + 0.1,
+                    index=pd.MultiIndex.from_tuples([("a", 150)]))])
+    y2, history2 = run_tsne(df2, init=previous, perplexity=10.,
+                            random_state=1, verbose=False)
+    assert y2.shape == (146, 2)
+    assert history2.index[-1] < history.index[-1] / 2, "Warm start was not faster"
+    # The new row is placed and stays in its cluster
+    _, nearest = NeighborIndex(pd.DataFrame(y2[:-1])).trees[
+        "ambient"].query(y2[-1], k=5)
+    assert np.all(groups[5:][nearest] == "a")
+
+    # An array init is not exaggerated either, so the layout is kept
+    y3, history3 = run_tsne(arr, init=y, perplexity=10., random_state=1,
+                            verbose=False)
+    assert history3.index[-1] < history.index[-1] / 2
+    _, nearest = NeighborIndex(pd.DataFrame(y3)).trees[
+        "ambient"].query(y3, k=2)
+    assert np.all(groups[nearest[:, 1]] == groups), "Clusters are mixed"
+
+    # Wrong initializations
+    for init in (previous, y[:10], "spectral"):
+        try:
+            run_tsne(arr, init=init, verbose=False)
+        except ValueError as e: print(e)
+        else: raise AssertionError("Wrong init was accepted")
+
 if __name__ == "__main__":
     #test_blocks()
     #test_ndimarray()